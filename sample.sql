@@ -1,4 +1,6 @@
-with jt1 as ( 
+with
+-- ------------------------------------------------------------
+jt1 as ( 
   select 
     * 
   from 
@@ -7,6 +9,7 @@ with jt1 as (
     a > 100 
       and b between 12 and 45
 ), 
+-- ------------------------------------------------------------
 
 jt2 as ( 
   select 
@@ -15,6 +18,7 @@ jt2 as (
     ( 
       select 
         a, 
+        -- ----------------------------------------
         b, 
         case 
           when c = 'some_value' 
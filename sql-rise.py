@@ -6,221 +6,392 @@ SQL River-Style Formatter - Unified Architecture
 - Primary and secondary river line support
 """
 
+import functools
+import os
 import sys
 import re
-from typing import List, Dict, Optional
+from typing import List, NamedTuple, Optional, Tuple
 
-class SQLToken:
-    def __init__(self, token_type: str, content: str, line_num: int = 0):
-        self.type = token_type  # 'LEFT_CLAUSE', 'RIGHT_SENTENCE', 'CONTINUATION', 'SEPARATOR'
-        self.content = content
-        self.line_num = line_num
+class LineKind:
+    """Kind of a logical line, decided while splitting so formatting need not re-detect it"""
+    SELECT = 'SELECT'              # SELECT keyword, optionally followed by the first item
+    CLAUSE = 'CLAUSE'              # FROM, WHERE, GROUP BY, ORDER BY, HAVING, UNION [ALL]
+    COMMA = 'COMMA'                # Comma-first continuation
+    AND_OR = 'AND_OR'              # Logical operator continuation
+    SEMICOLON = 'SEMICOLON'        # Statement terminator
+    COMMENT = 'COMMENT'            # Line comment
+    COMMENT_LINE = 'COMMENT_LINE'  # Input line holding only a comment
+    CONTINUATION = 'CONTINUATION'  # Anything else; classified when formatted
+
+# Keywords recognised after '--' as a commented-out clause
+_COMMENT_KEYWORDS = r'(?:SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|JOIN|LEFT\s+JOIN|RIGHT\s+JOIN|INNER\s+JOIN|FULL\s+JOIN|CROSS\s+JOIN|UNION|WITH|AS|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)'
+
+# Extended LEFT CLAUSE patterns
+_LEFT_CLAUSE_SOURCES = [
+    # Basic SQL clauses
+    r'\bSELECT\s+DISTINCT\b', r'\bSELECT\b',
+    r'\bFROM\b', r'\bWHERE\b', r'\bGROUP\s+BY\b', r'\bHAVING\b',
+    r'\bORDER\s+BY\b', r'\bLIMIT\b',
+    
+    # JOIN types
+    r'\bFULL\s+OUTER\s+JOIN\b', r'\bLEFT\s+OUTER\s+JOIN\b', r'\bRIGHT\s+OUTER\s+JOIN\b',
+    r'\bINNER\s+JOIN\b', r'\bLEFT\s+JOIN\b', r'\bRIGHT\s+JOIN\b', r'\bFULL\s+JOIN\b',
+    r'\bCROSS\s+JOIN\b', r'\bJOIN\b',
+    
+    # UNION types
+    r'\bUNION\s+ALL\b', r'\bUNION\b',
+    
+    # CTE and structure
+    r'\bWITH\b', r'\bAS\b',
+    
+    # DDL and DML
+    r'\bCREATE\s+TEMP\s+TABLE\b', r'\bCREATE\s+TABLE\b',
+    r'\bINSERT\s+INTO\b', r'\bUPDATE\b', r'\bSET\b', r'\bDELETE\b',
+    
+    # Comments
+    r'--\s*,', r'--\s*\b' + _COMMENT_KEYWORDS + r'\b', r'--',
+    
+    # Other
+    r'\bDECLARE\b', r'\bDO\b',
+]
+
+# All LEFT CLAUSE patterns fused into one alternation. Alternatives sharing a
+# prefix are listed longest-first, so the first alternative that matches is
+# the widest clause (SELECT DISTINCT before SELECT, UNION ALL before UNION).
+# .match() anchors it at the start of a line.
+_LEFT_CLAUSE_ALTERNATION = '|'.join(f'(?:{p})' for p in _LEFT_CLAUSE_SOURCES)
+_COMBINED_LEFT_CLAUSE_RE = re.compile(_LEFT_CLAUSE_ALTERNATION, re.IGNORECASE)
+
+# Letters a LEFT CLAUSE keyword can start with, in either case, plus the
+# non-ASCII letters that IGNORECASE matches to them ('İ', 'ı' and 'ſ')
+_LEFT_CLAUSE_INITIALS = frozenset('ACDFGHIJLORSUW' + 'acdfghijlorsuw' + '-\u0130\u0131\u017f')
+
+# Keyword trie over the same clauses, for scanning a whole input in one pass.
+# Shared prefixes are factored out (LEFT [OUTER] JOIN, UNION [ALL], ...) so each
+# position tries a handful of branches instead of every pattern in turn, and
+# optional tails are greedy so the widest clause wins. A comment consumes only
+# '--' (the last pair of a dash run) and captures the keyword after it without
+# consuming it, so that keyword is still scanned as a clause of its own, as it
+# was when each pattern scanned the input separately. The last branch captures
+# continuations: a line that, once stripped, starts with a comma or with
+# 'AND '/'OR ' followed by more text. The scan runs case-sensitively over
+# the input with its keyword letters uppercased (_KEYWORD_FOLD); AND/OR count
+# only when uppercase in the input itself, which the caller checks.
+_CLAUSE_WORDS = (
+    r'\b(?:SELECT(?:\s+DISTINCT)?|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT'
+    r'|(?:(?:FULL|LEFT|RIGHT)(?:\s+OUTER)?\s+|INNER\s+|CROSS\s+)?JOIN|UNION(?:\s+ALL)?'
+    r'|WITH|AS|CREATE\s+(?:TEMP\s+)?TABLE|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)\b'
+)
+_LEFT_CLAUSE_SCAN_RE = re.compile(
+    _CLAUSE_WORDS +
+    r'|--(?!-)(?:\s*,|\s*(?=(\b' + _COMMENT_KEYWORDS + r'\b)))?'
+    r'|^[^\S\n]*(,|(?:AND|OR)(?= [^\S\n]*\S))',
+    re.MULTILINE)
+
+# Comment lines: '--' before a comma, before a clause keyword, and the prefix
+# to normalize to '-- '
+_COMMENT_COMMA_RE = re.compile(r'^--\s*,')
+_COMMENT_CLAUSE_RE = re.compile(r'^--\s*(SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|INNER\s+JOIN|LEFT\s+JOIN|RIGHT\s+JOIN|FULL\s+OUTER\s+JOIN|LEFT\s+OUTER\s+JOIN|RIGHT\s+OUTER\s+JOIN|FULL\s+JOIN|CROSS\s+JOIN|JOIN|UNION\s+ALL|UNION|WITH|AS|CREATE\s+TEMP\s+TABLE|CREATE\s+TABLE|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)\b', re.IGNORECASE)
+_COMMENT_PREFIX_RE = re.compile(r'^--\s*')
+_COMMENT_CLAUSE_PATTERNS = (
+    (_COMMENT_COMMA_RE, '-- ,'),  # Comment comma
+    (_COMMENT_CLAUSE_RE, '-- {keyword}'),
+)
+
+# CTE scan over the uppercased input: line comments, CTE heads (WITH name
+# AS ( and , name AS (), brackets and SELECT words; and AS ( inside a line.
+# Line comments may stand anywhere a CTE head allows whitespace; each one
+# runs to the end of its line, so a run of dashes is read one way only.
+_CTE_GAP = r'(?:\s|--[^\n]*(?![^\n]))'
+_CTE_SCAN_RE = re.compile(
+    r'--[^\n]*'
+    r'|(?:\b(WITH)' + _CTE_GAP + r'+(?:RECURSIVE' + _CTE_GAP + r'+)?|,' + _CTE_GAP + r'*)'
+    r'(\w+)' + _CTE_GAP + r'+AS' + _CTE_GAP + r'*\('
+    r'|([()])'
+    r'|\b(SELECT)\b')
+_AS_PAREN_RE = re.compile(r'\bAS\s*\(', re.IGNORECASE)
+_AS_PAREN_SPLIT_RE = re.compile(r'(\bAS)\s*\(', re.IGNORECASE)
+# Clauses that start the main query after the last CTE
+_MAIN_QUERY_START_RE = re.compile(r'(?:SELECT|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+# Secondary river clauses (CASE statements)
+_CASE_KEYWORDS = frozenset({'CASE', 'WHEN', 'THEN', 'ELSE', 'END'})
+_CASE_WHEN_RE = re.compile(r'\bCASE\s+WHEN\b', re.IGNORECASE)
+_COMMA_CASE_WHEN_THEN_RE = re.compile(r'(,\s*CASE\s+WHEN\s+.*?)\s+(THEN\s+.*)', re.IGNORECASE)
+_CASE_WHEN_THEN_RE = re.compile(r'(CASE\s+WHEN\s+.*?)\s+(THEN\s+.*)', re.IGNORECASE)
+_WHEN_THEN_RE = re.compile(r'(WHEN\s+.*?)\s+(THEN\s+.*)', re.IGNORECASE)
+
+# Secondary river clauses in one pass over the uppercased input: CASE [WHEN] (groups 1
+# and 2), WHEN/THEN/ELSE/END (group 3) and SELECT/FROM/WHERE right after '('
+# (group 4). Only WHEN is ever consumed past a keyword, and it is reported.
+_SECONDARY_SCAN_RE = re.compile(
+    r'\b(?:(CASE)(?:\s+(WHEN))?|(WHEN|THEN|ELSE|END))\b|\(\s*(SELECT|FROM|WHERE)\b')
+
+# CASE keywords followed by a space anywhere in a line (not only as whole
+# words), where the river check tolerates a non-space at the river
+_CASE_CONTEXT_RE = re.compile(r'(?:WHEN|THEN|ELSE|END) ', re.IGNORECASE)
+
+# Any clause or CASE keyword; input without one has nothing to align
+_SQL_KEYWORD_RE = re.compile(_CLAUSE_WORDS + r'|\b(?:CASE|WHEN|THEN|ELSE|END)\b', re.IGNORECASE)
+
+# Subqueries: (SELECT, and the split around it
+_SUBQUERY_SELECT_RE = re.compile(r'\(\s*SELECT\b', re.IGNORECASE)
+_SUBQUERY_SPLIT_RE = re.compile(r'(.*?)\(\s*(SELECT\b)(.*)', re.IGNORECASE)
+
+# Keywords that start a new logical line, and those that may combine with
+# the following word (GROUP BY, ORDER BY, UNION ALL)
+_SPLIT_KEYWORDS = frozenset({'SELECT', 'FROM', 'WHERE', 'GROUP', 'BY', 'ORDER', 'HAVING', 'UNION', 'AND', 'OR'})
+_COMPOUND_HEADS = frozenset({'GROUP', 'ORDER', 'UNION'})
+
+# Line kind of a logical line, by the (uppercased) token that starts it
+_LINE_KIND_BY_KEYWORD = {
+    'SELECT': LineKind.SELECT,
+    'FROM': LineKind.CLAUSE, 'WHERE': LineKind.CLAUSE, 'HAVING': LineKind.CLAUSE,
+    'UNION': LineKind.CLAUSE, 'GROUP BY': LineKind.CLAUSE, 'ORDER BY': LineKind.CLAUSE,
+    'UNION ALL': LineKind.CLAUSE,
+    'AND': LineKind.AND_OR, 'OR': LineKind.AND_OR,
+}
+_COMPOUND_CLAUSES = ('GROUP BY', 'ORDER BY', 'UNION ALL')
+
+# Tokens for splitting: a comma or semicolon on its own, or a run of
+# anything else up to whitespace, and the next non-space for lookahead
+_TOKEN_RE = re.compile(r'[,;]|[^\s,;]+')
+_NONSPACE_RE = re.compile(r'\S')
+
+# Length-preserving uppercase for keyword comparisons: ASCII letters plus the
+# two non-ASCII letters that uppercase to one ASCII letter ('ı' and 'ſ')
+_KEYWORD_UPPER = str.maketrans('abcdefghijklmnopqrstuvwxyz\u0131\u017f',
+                               'ABCDEFGHIJKLMNOPQRSTUVWXYZIS')
+
+# Length-preserving fold for the whole-input scans: every letter that an
+# IGNORECASE match of an ASCII keyword accepts ('İ', 'ı', 'ſ' and the Kelvin
+# sign included) becomes its ASCII uppercase, so the scans can drop IGNORECASE
+_KEYWORD_FOLD = str.maketrans('abcdefghijklmnopqrstuvwxyz\u0130\u0131\u017f\u212a',
+                              'ABCDEFGHIJKLMNOPQRSTUVWXYZIISK')
+
+class _FormatState(NamedTuple):
+    """Per-input state left by formatting, saved alongside each cached result"""
+    primary_river_pos: int
+    secondary_river_pos: int
+    max_clause_length: int
+    max_secondary_length: int
+    secondary_clauses: frozenset
+    cte_structure: tuple
+
+# State of a formatter that has aligned nothing: no rivers, clauses or CTEs
+_BLANK_FORMAT_STATE = _FormatState(0, 0, 0, 0, frozenset(), ())
 
 class RiverFormatter:
     def __init__(self):
-        self.primary_river_pos = 0
+        self._set_primary_river(0)  # Also builds the clause emitter
         self.secondary_river_pos = 0
-        self.left_clauses = []
-        self.secondary_clauses = []  # CASE, WHEN, THEN, ELSE, END for secondary river
+        self.max_clause_length = 0  # Widest LEFT CLAUSE found in the input
+        self.secondary_clauses = set()  # CASE, WHEN, THEN, ELSE, END for secondary river
+        self.max_secondary_length = 0  # Widest of the secondary clauses
         self.cte_structure = []  # Track CTE structure: [{'name': 'cte1', 'start_line': 1, 'end_line': 5}, ...]
         self.subquery_depth = 0  # Track nesting depth of subqueries
         
-        # Extended LEFT CLAUSE patterns
-        self.left_clause_patterns = [
-            # Basic SQL clauses
-            r'\bSELECT\s+DISTINCT\b', r'\bSELECT\b',
-            r'\bFROM\b', r'\bWHERE\b', r'\bGROUP\s+BY\b', r'\bHAVING\b',
-            r'\bORDER\s+BY\b', r'\bLIMIT\b',
-            
-            # JOIN types
-            r'\bFULL\s+OUTER\s+JOIN\b', r'\bLEFT\s+OUTER\s+JOIN\b', r'\bRIGHT\s+OUTER\s+JOIN\b',
-            r'\bINNER\s+JOIN\b', r'\bLEFT\s+JOIN\b', r'\bRIGHT\s+JOIN\b', r'\bFULL\s+JOIN\b',
-            r'\bCROSS\s+JOIN\b', r'\bJOIN\b',
-            
-            # UNION types
-            r'\bUNION\s+ALL\b', r'\bUNION\b',
-            
-            # CTE and structure
-            r'\bWITH\b', r'\bAS\b',
-            
-            # DDL and DML
-            r'\bCREATE\s+TEMP\s+TABLE\b', r'\bCREATE\s+TABLE\b',
-            r'\bINSERT\s+INTO\b', r'\bUPDATE\b', r'\bSET\b', r'\bDELETE\b',
-            
-            # Comments
-            r'--\s*,', r'--\s*\b(?:SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|JOIN|LEFT\s+JOIN|RIGHT\s+JOIN|INNER\s+JOIN|FULL\s+JOIN|CROSS\s+JOIN|UNION|WITH|AS|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)\b', r'--',
-            
-            # Other
-            r'\bDECLARE\b', r'\bDO\b',
-        ]
-        
-        # Continuation patterns (special LEFT CLAUSE)
-        self.continuation_patterns = [
-            r'^\s*,\s*',  # Comma continuation
-            r'^\s*AND\b', r'^\s*OR\b',  # Logical operators
-        ]
-        
-        # Secondary river patterns (CASE statements)
-        self.secondary_clause_patterns = [
-            r'\bCASE\b', r'\bWHEN\b', r'\bTHEN\b', r'\bELSE\b', r'\bEND\b'
-        ]
+        # Formatters for lines whose kind was decided while splitting,
+        # each called with (stripped line, in_subquery)
+        self._kind_formatters = {
+            LineKind.COMMA: lambda line, in_subquery: self._format_comma_line(line),
+            LineKind.SEMICOLON: lambda line, in_subquery: self._format_semicolon_line(),
+            LineKind.COMMENT: lambda line, in_subquery: self._format_comment_line(line),
+            LineKind.COMMENT_LINE: lambda line, in_subquery: self._format_comment_line(line),
+            LineKind.SELECT: self._format_select_kind,
+            LineKind.CLAUSE: self._format_clause_kind,
+            LineKind.AND_OR: self._format_and_or_kind,
+        }
         
     def format_sql(self, sql: str) -> str:
         """Main entry point for SQL formatting"""
-        if not sql.strip():
+        # Test for blank input without building a stripped copy
+        if not sql or sql.isspace():
             return sql
-            
+        
+        # Fragments without any SQL keyword (plain text, comment-only input)
+        # are returned as-is rather than aligned to a river
+        if not _SQL_KEYWORD_RE.search(sql):
+            self._restore_format_state(_BLANK_FORMAT_STATE)
+            return sql
+        
+        # The same input always formats the same way, so reuse a cached
+        # result along with the river state it left behind
+        formatted, state = _format_sql_cached(type(self), sql)
+        self._restore_format_state(state)
+        return formatted
+    
+    def _format_sql_uncached(self, sql: str) -> str:
+        """Run the full formatting pipeline on non-blank SQL"""
+        # Uppercase the keyword letters once, so the whole-input scans below
+        # can match case-sensitively at the same offsets as in sql
+        sql_upper = sql.translate(_KEYWORD_FOLD)
+        
         # Step 1: Analyze CTE structure
-        self._analyze_cte_structure(sql)
+        self._analyze_cte_structure(sql_upper)
+        
+        # Step 2: Split the input into typed logical lines
+        logical_lines = self._split_input_lines(sql)
         
-        # Step 2: Global scan to find all LEFT CLAUSES
-        self._extract_all_left_clauses(sql)
+        # Step 3: Global scan to find all LEFT CLAUSES
+        self._extract_all_left_clauses(sql, sql_upper, logical_lines)
         
-        # Step 3: Extract secondary clauses
-        self._extract_secondary_clauses(sql)
+        # Step 4: Extract secondary clauses
+        self._extract_secondary_clauses(sql_upper)
         
-        # Step 4: Calculate primary and secondary river line positions
+        # Step 5: Calculate primary and secondary river line positions
         self._calculate_primary_river()
         self._calculate_secondary_river()
         
-        # Step 5: Format the SQL
-        formatted = self._format_with_river(sql)
+        # Step 6: Format the logical lines
+        formatted = self._format_with_river(logical_lines)
         
         return formatted
     
-    def _analyze_cte_structure(self, sql: str):
+    def _save_format_state(self) -> _FormatState:
+        """Snapshot the per-input state left by formatting, for the result cache"""
+        return _FormatState(
+            primary_river_pos=self.primary_river_pos,
+            secondary_river_pos=self.secondary_river_pos,
+            max_clause_length=self.max_clause_length,
+            max_secondary_length=self.max_secondary_length,
+            secondary_clauses=frozenset(self.secondary_clauses),
+            cte_structure=tuple(self.cte_structure))
+    
+    def _restore_format_state(self, state: _FormatState):
+        """Restore a snapshot taken by _save_format_state onto this formatter"""
+        self._set_primary_river(state.primary_river_pos)
+        self.secondary_river_pos = state.secondary_river_pos
+        self.max_clause_length = state.max_clause_length
+        self.max_secondary_length = state.max_secondary_length
+        self.secondary_clauses = set(state.secondary_clauses)
+        self.cte_structure = [dict(cte) for cte in state.cte_structure]
+    
+    def _analyze_cte_structure(self, sql_upper: str):
         """Analyze CTE structure to identify boundaries and nesting"""
         self.cte_structure = []
         
-        # Remove comments for accurate analysis
-        sql_clean = self._remove_comments(sql)
-        # For single-line SQL with multiple CTEs, use regex to find CTE boundaries
-        cte_pattern = r'\bWITH\s+(\w+)\s+AS\s*\([^)]*\)(?:\s*,\s*(\w+)\s+AS\s*\([^)]*\))*'
-        
-        # Find all CTE definitions
-        cte_matches = list(re.finditer(r'(\w+)\s+AS\s*(\([^)]+\))', sql_clean, re.IGNORECASE))
-        
-        if cte_matches:
-            for i, match in enumerate(cte_matches):
-                cte_name = match.group(1).upper()
-                cte_content = match.group(2)
-                
-                # Add CTE to structure
-                self.cte_structure.append({
-                    'name': cte_name,
-                    'start_line': 1,  # All on same line for single-line SQL
-                    'end_line': 1,
-                    'has_parentheses': True
-                })
-            
-            # Check if there's a main query after CTEs
-            # Find the position after the last CTE
-            if cte_matches:
-                last_match = cte_matches[-1]
-                remaining_sql = sql_clean[last_match.end():].strip()
-                if re.search(r'\bSELECT\b', remaining_sql, re.IGNORECASE):
+        # Walk comments, CTE heads, brackets and SELECTs in a single pass,
+        # matching each CTE's brackets by depth so that nested parentheses
+        # in its body do not end it early
+        depth = 0
+        cte_name = None
+        has_main_query = False
+        for match in _CTE_SCAN_RE.finditer(sql_upper):
+            with_keyword, name, paren, select = match.groups()
+            if name:
+                if depth or not (with_keyword or self.cte_structure):
+                    # Not a CTE definition, only its opening bracket counts
+                    depth += 1
+                    continue
+                cte_name = name.upper()
+                depth = 1
+                has_main_query = False
+            elif paren == '(':
+                depth += 1
+            elif paren and depth:
+                depth -= 1
+                if not depth and cte_name:
+                    # Add CTE to structure
                     self.cte_structure.append({
-                        'name': 'MAIN_QUERY',
-                        'start_line': 1,
+                        'name': cte_name,
+                        'start_line': 1,  # All on same line for single-line SQL
                         'end_line': 1,
-                        'has_parentheses': False
+                        'has_parentheses': True
                     })
+                    cte_name = None
+            elif select and not cte_name and self.cte_structure:
+                # A SELECT after the last CTE is the main query
+                has_main_query = True
+        
+        if has_main_query:
+            self.cte_structure.append({
+                'name': 'MAIN_QUERY',
+                'start_line': 1,
+                'end_line': 1,
+                'has_parentheses': False
+            })
     
-    def _extract_all_left_clauses(self, sql: str):
-        """Extract all LEFT CLAUSES from entire input to calculate global river"""
-        self.left_clauses = []
-        
-        # First, find all LEFT CLAUSE patterns (including comments)
-        for pattern in self.left_clause_patterns:
-            matches = re.finditer(pattern, sql, re.IGNORECASE)
-            for match in matches:
-                clause = match.group().strip()
-                # Normalize whitespace in multi-word clauses
-                clause = ' '.join(clause.split())
-                if clause not in self.left_clauses:
-                    self.left_clauses.append(clause)
-        
-        # Also check for continuation commas and operators in each line
-        lines = sql.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith(','):
-                self.left_clauses.append(',')
-            elif line.startswith('AND ') or line.startswith('OR '):
-                parts = line.split(None, 1)
-                if parts:
-                    self.left_clauses.append(parts[0])
-            elif line.startswith('--'):
-                # Check for comment patterns
-                if re.match(r'^--\s*,', line):
-                    comment_clause = '-- ,'
-                    if comment_clause not in self.left_clauses:
-                        self.left_clauses.append(comment_clause)
-                elif re.match(r'^--\s*\b(?:SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|INNER\s+JOIN|LEFT\s+JOIN|RIGHT\s+JOIN|FULL\s+OUTER\s+JOIN|LEFT\s+OUTER\s+JOIN|RIGHT\s+OUTER\s+JOIN|FULL\s+JOIN|CROSS\s+JOIN|JOIN|UNION\s+ALL|UNION|WITH|AS|CREATE\s+TEMP\s+TABLE|CREATE\s+TABLE|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)\b', line, re.IGNORECASE):
-                    # Extract the comment + keyword as a clause
-                    match = re.match(r'^--\s*(\b(?:SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|INNER\s+JOIN|LEFT\s+JOIN|RIGHT\s+JOIN|FULL\s+OUTER\s+JOIN|LEFT\s+OUTER\s+JOIN|RIGHT\s+OUTER\s+JOIN|FULL\s+JOIN|CROSS\s+JOIN|JOIN|UNION\s+ALL|UNION|WITH|AS|CREATE\s+TEMP\s+TABLE|CREATE\s+TABLE|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)\b)', line, re.IGNORECASE)
-                    if match:
-                        keyword = match.group(1).upper()
-                        comment_clause = f'-- {keyword}'
-                        if comment_clause not in self.left_clauses:
-                            self.left_clauses.append(comment_clause)
+    def _extract_all_left_clauses(self, sql: str, sql_upper: str,
+                                  logical_lines: List[Tuple[str, str]]):
+        """Find the widest LEFT CLAUSE in the entire input to calculate global river"""
+        max_length = 0
+        
+        # First, find all LEFT CLAUSE patterns (including comments and
+        # continuation lines) in one pass
+        for match in _LEFT_CLAUSE_SCAN_RE.finditer(sql_upper):
+            continuation = match.group(2)
+            if continuation:
+                # AND/OR only continue a line when written in uppercase
+                if sql.startswith(continuation, match.start(2)):
+                    max_length = max(max_length, len(continuation))
+                continue
+            clause = match.group()
+            # A commented-out keyword is captured after the consumed '--'
+            keyword = match.group(1)
+            if keyword:
+                clause += keyword
+            # Normalizing whitespace only shortens a clause, so it is only
+            # worth doing when the raw match is wider than the current max
+            if len(clause) > max_length:
+                max_length = max(max_length, len(' '.join(clause.split())))
+        
+        # And for comment lines, already picked out when the input was split
+        for line_kind, line in logical_lines:
+            if line_kind != LineKind.COMMENT_LINE:
+                continue
+            # Check for comment patterns
+            if _COMMENT_COMMA_RE.match(line):
+                clause = '-- ,'
+            else:
+                # Extract the comment + keyword as a clause
+                match = _COMMENT_CLAUSE_RE.match(line)
+                if match:
+                    keyword = match.group(1).upper()
+                    clause = f'-- {keyword}'
                 else:
                     # Just comment
-                    if '--' not in self.left_clauses:
-                        self.left_clauses.append('--')
-    
-    def _remove_comments(self, sql: str) -> str:
-        """Remove SQL comments for pattern matching"""
-        # Remove line comments
-        lines = sql.split('\n')
-        clean_lines = []
-        for line in lines:
-            if '--' in line:
-                line = line[:line.find('--')]
-            clean_lines.append(line)
-        return '\n'.join(clean_lines)
+                    clause = '--'
+            max_length = max(max_length, len(clause))
+        
+        self.max_clause_length = max_length
     
     def _calculate_primary_river(self):
         """Calculate primary river line position from all LEFT CLAUSES"""
-        if not self.left_clauses:
-            self.primary_river_pos = 7
-            return
-            
-        max_clause_length = max(len(clause) for clause in self.left_clauses)
-        self.primary_river_pos = 7 + max_clause_length
+        self._set_primary_river(7 + self.max_clause_length)
     
-    def _extract_secondary_clauses(self, sql: str):
+    def _set_primary_river(self, river_pos: int):
+        """Set the primary river position and the helpers derived from it"""
+        self.primary_river_pos = river_pos
+        
+        # Clause emitter for this river, so lines ending at the primary river
+        # need not look up its position again
+        def emit_clause(clause: str, remaining: str) -> str:
+            if remaining:
+                return f"{clause.rjust(river_pos)} {remaining}"
+            return clause.rjust(river_pos)
+        self._emit_clause = emit_clause
+    
+    def _extract_secondary_clauses(self, sql_upper: str):
         """Extract secondary clauses for both CASE and subquery contexts"""
-        self.secondary_clauses = []
-        
-        # For CASE statements: extract CASE WHEN as compound clause
-        case_when_pattern = r'\bCASE\s+WHEN\b'
-        case_when_matches = re.finditer(case_when_pattern, sql, re.IGNORECASE)
-        for match in case_when_matches:
-            clause = 'CASE WHEN'
-            if clause not in self.secondary_clauses:
-                self.secondary_clauses.append(clause)
-        
-        # For subqueries: extract SELECT and other SQL clauses within parentheses
-        # This is a simplified approach - could be enhanced with proper parentheses parsing
-        subquery_patterns = [r'\(\s*SELECT\b', r'\(\s*FROM\b', r'\(\s*WHERE\b']
-        for pattern in subquery_patterns:
-            matches = re.finditer(pattern, sql, re.IGNORECASE)
-            for match in matches:
-                # Extract the clause part (e.g., "SELECT" from "(SELECT")
-                clause_match = re.search(r'\b(SELECT|FROM|WHERE)\b', match.group(), re.IGNORECASE)
-                if clause_match:
-                    clause = clause_match.group().upper()
-                    if clause not in self.secondary_clauses:
-                        self.secondary_clauses.append(clause)
-        
-        # Also add other secondary patterns
-        for pattern in self.secondary_clause_patterns:
-            matches = re.finditer(pattern, sql, re.IGNORECASE)
-            for match in matches:
-                clause = match.group().strip().upper()
-                if clause not in self.secondary_clauses:
-                    self.secondary_clauses.append(clause)
+        self.secondary_clauses = set()
+        max_length = 0
+        
+        # CASE statements (with CASE WHEN as a compound clause) and the
+        # clause that opens a subquery, e.g. "SELECT" from "(SELECT"
+        for match in _SECONDARY_SCAN_RE.finditer(sql_upper):
+            case, when, keyword, subquery_clause = match.groups()
+            if case:
+                self.secondary_clauses.add('CASE')
+                if when:
+                    self.secondary_clauses.update(('WHEN', 'CASE WHEN'))
+                clause = 'CASE WHEN' if when else 'CASE'
+            else:
+                clause = keyword or subquery_clause
+                self.secondary_clauses.add(clause)
+            max_length = max(max_length, len(clause))
+        
+        self.max_secondary_length = max_length
     
     def _calculate_secondary_river(self):
         """Calculate secondary river line position"""
@@ -229,9 +400,6 @@ class RiverFormatter:
             self.secondary_river_pos = self.primary_river_pos + 10
             return
         
-        # Find the maximum length of secondary clauses
-        max_secondary_length = max(len(clause) for clause in self.secondary_clauses)
-        
         # Check if we have CASE WHEN (CASE context)
         has_case_when = 'CASE WHEN' in self.secondary_clauses
         
@@ -241,163 +409,116 @@ class RiverFormatter:
         else:
             # Subquery context: primary + 1 (for primary river space) + proper gap
             # For subqueries, use max secondary clause length + 3 margin + 1 for river space
-            self.secondary_river_pos = self.primary_river_pos + max_secondary_length + 4
+            self.secondary_river_pos = self.primary_river_pos + self.max_secondary_length + 4
     
-    def _format_with_river(self, sql: str) -> str:
-        """Format SQL using calculated river line - preserve all original tokens"""
+    def _split_input_lines(self, sql: str) -> List[Tuple[str, str]]:
+        """Split the whole input into (LineKind, text) logical lines"""
         # First, split by actual lines, then process each line for logical formatting
-        input_lines = sql.split('\n')
         logical_lines = []
         
-        for line in input_lines:
-            if line.strip().startswith('--'):
+        for line in sql.split('\n'):
+            stripped = line.strip()
+            if not stripped:
+                # Blank lines produce no logical lines
+                continue
+            if stripped.startswith('--'):
                 # Comment line - keep as is
-                logical_lines.append(line.strip())
+                logical_lines.append((LineKind.COMMENT_LINE, stripped))
             else:
                 # SQL line - split into logical parts
-                sql_logical = self._split_into_logical_lines(line)
-                logical_lines.extend(sql_logical)
+                logical_lines.extend(self._split_into_logical_lines(stripped))
         
+        return logical_lines
+    
+    def _format_with_river(self, logical_lines: List[Tuple[str, str]]) -> str:
+        """Format logical lines using calculated river line - preserve all original tokens"""
         formatted_lines = []
         line_num = 0
         
+        # Stripped and uppercased text of every logical line, computed once
+        # so the lookahead below can compare neighbours without re-deriving them
+        lines = [logical_line.strip() for _, logical_line in logical_lines]
+        uppers = [line.upper() for line in lines]
+        line_count = len(lines)
+        
         # Track parentheses context for subquery detection
         paren_depth = 0
         in_subquery = False
         
         i = 0
-        while i < len(logical_lines):
+        while i < line_count:
             line_num += 1
-            logical_line = logical_lines[i]
+            line_kind = logical_lines[i][0]
+            current_line = lines[i]
             
-            if not logical_line.strip():
+            if not current_line:
                 formatted_lines.append('')
                 i += 1
                 continue
             
-            # Check for WHEN THEN combination patterns
-            current_upper = logical_line.strip().upper()
-            
-            # Debug output for combination logic (disabled)
-            # if 'CASE' in current_upper or 'WHEN' in current_upper or 'THEN' in current_upper:
-            #     print(f"DEBUG: Line {i}: {repr(logical_line)} -> {repr(current_upper)}")
-            #     if i + 1 < len(logical_lines):
-            #         next_upper = logical_lines[i + 1].strip().upper() 
-            #         print(f"DEBUG: Next {i+1}: {repr(logical_lines[i + 1])} -> {repr(next_upper)}")
-            
-            # Pattern 1: WHEN ... followed by line starting with THEN
-            if (current_upper.startswith('WHEN ') and 
-                i + 1 < len(logical_lines) and 
-                logical_lines[i + 1].strip().upper().startswith('THEN ')):
-                
-                # Combine WHEN and THEN into single line
-                when_part = logical_line.strip()
-                then_part = logical_lines[i + 1].strip()
-                combined_line = f"{when_part} {then_part}"
-                
-                # Format the combined line
-                formatted_line = self._format_case_clause(combined_line)
-                formatted_lines.append(formatted_line)
-                i += 2  # Skip both WHEN and THEN lines
-                continue
-            
-            # Pattern 2: CASE WHEN followed by line starting with THEN (including comma-first)
-            elif ((current_upper.startswith('CASE WHEN ') or current_upper.startswith(', CASE WHEN ')) and 
-                  i + 1 < len(logical_lines) and 
-                  logical_lines[i + 1].strip().upper().startswith('THEN ')):
-                
-                # Debug output (disabled)
-                # print(f"DEBUG: Pattern 2 matched - {repr(logical_line)} + {repr(logical_lines[i + 1])}")
-                
-                # Combine CASE WHEN and THEN into single line
-                case_when_part = logical_line.strip()
-                then_part = logical_lines[i + 1].strip()
-                combined_line = f"{case_when_part} {then_part}"
-                
-                # Format the combined line as CASE clause
-                formatted_line = self._format_case_clause(combined_line)
-                formatted_lines.append(formatted_line)
-                i += 2  # Skip both CASE WHEN and THEN lines
-                continue
-            
-            # Pattern 3: CASE WHEN (keywords only) followed by condition ending with THEN
-            elif (current_upper == 'CASE WHEN' and 
-                  i + 1 < len(logical_lines) and 
-                  logical_lines[i + 1].strip().upper().endswith(' THEN')):
-                
-                # Combine CASE WHEN keywords with condition + THEN
-                case_when_keywords = logical_line.strip()
-                condition_then = logical_lines[i + 1].strip()
-                combined_line = f"{case_when_keywords} {condition_then}"
-                
-                # Format the combined line as CASE clause  
-                formatted_line = self._format_case_clause(combined_line)
-                formatted_lines.append(formatted_line)
-                i += 2  # Skip both lines
-                continue
-            
-            # Pattern 4: WHEN (keyword only) followed by condition ending with THEN
-            elif (current_upper == 'WHEN' and 
-                  i + 1 < len(logical_lines) and 
-                  logical_lines[i + 1].strip().upper().endswith(' THEN')):
-                
-                # Combine WHEN keyword with condition + THEN
-                when_keyword = logical_line.strip()
-                condition_then = logical_lines[i + 1].strip()
-                combined_line = f"{when_keyword} {condition_then}"
-                
-                # Format the combined line as CASE clause
-                formatted_line = self._format_case_clause(combined_line)
-                formatted_lines.append(formatted_line)
-                i += 2  # Skip both lines
-                continue
-            
-            current_line = logical_line.strip()
+            # Combine WHEN/CASE WHEN with the THEN line that follows it:
+            # WHEN ... / CASE WHEN ... (including comma-first) followed by a
+            # line starting with THEN, or the bare CASE WHEN / WHEN keywords
+            # followed by a condition ending with THEN
+            if i + 1 < line_count:
+                current_upper = uppers[i]
+                next_upper = uppers[i + 1]
+                if ((current_upper.startswith(('WHEN ', 'CASE WHEN ', ', CASE WHEN ')) and
+                     next_upper.startswith('THEN ')) or
+                    (current_upper in ('CASE WHEN', 'WHEN') and next_upper.endswith(' THEN'))):
+                    combined_line = f"{current_line} {lines[i + 1]}"
+                    
+                    # Format the combined line as CASE clause
+                    formatted_lines.append(self._format_case_clause(combined_line))
+                    i += 2  # Skip both lines
+                    continue
             
             # Store current subquery context for formatting this line
             format_in_subquery = in_subquery
             
             # Update parentheses context tracking for next lines
+            # Count each bracket once: on a line without any, count() costs
+            # the same single scan that an 'in' test would
+            open_count = current_line.count('(')
+            close_count = current_line.count(')')
+            
             # Check for opening parentheses (including in combined lines like "FROM (")
-            if '(' in current_line:
-                paren_count = current_line.count('(')
-                paren_depth += paren_count
+            if open_count:
+                paren_depth += open_count
                 if paren_depth > 0:
                     in_subquery = True
             
             # Check for closing parentheses
-            if ')' in current_line:
-                paren_count = current_line.count(')')
-                paren_depth -= paren_count
+            if close_count:
+                paren_depth -= close_count
                 if paren_depth <= 0:
                     in_subquery = False
                     paren_depth = 0  # Don't go negative
             
             # Check for closing parenthesis followed by semicolon pattern
-            if (logical_line.strip() == ')' and 
-                i + 1 < len(logical_lines) and 
-                logical_lines[i + 1].strip() == ';'):
+            if (current_line == ')' and 
+                i + 1 < line_count and 
+                lines[i + 1] == ';'):
                 
                 # Combine ) and ; on the same line
                 close_paren_pos = self.primary_river_pos + 1
-                formatted_line = f"{' ' * close_paren_pos});"
+                formatted_line = f"{')'.rjust(close_paren_pos + 1)};"
                 formatted_lines.append(formatted_line)
                 i += 2  # Skip both ) and ; lines
                 continue
             
             # Check if this line needs CTE bracket processing
-            formatted_line = self._process_cte_brackets(logical_line.strip(), line_num)
-            if formatted_line is None:
+            bracket_lines = self._process_cte_brackets(current_line, line_num)
+            if bracket_lines is None:
                 # Check for CASE formatting
-                if self._is_case_line(logical_line.strip()):
-                    formatted_line = self._format_case_clause(logical_line.strip())
+                if self._is_case_line(current_line):
+                    formatted_line = self._format_case_clause(current_line)
                 else:
                     # Standard formatting - pass subquery context
-                    formatted_line = self._format_line_preserving_tokens(logical_line.strip(), format_in_subquery)
+                    formatted_line = self._format_line_preserving_tokens(current_line, format_in_subquery, line_kind)
                 formatted_lines.append(formatted_line)
             else:
                 # CTE bracket processing returned multiple lines
-                bracket_lines = formatted_line.split('\n')
                 formatted_lines.extend(bracket_lines)
             
             i += 1
@@ -407,12 +528,12 @@ class RiverFormatter:
         
         return '\n'.join(formatted_lines)
     
-    def _process_cte_brackets(self, line: str, line_num: int) -> Optional[str]:
+    def _process_cte_brackets(self, line: str, line_num: int) -> Optional[List[str]]:
         """Process CTE bracket formatting - opening bracket on same line as AS, closing bracket positioning"""
         # Check if this line contains AS ( or AS(
-        if re.search(r'\bAS\s*\(', line, re.IGNORECASE):
+        if _AS_PAREN_RE.search(line):
             # Split at AS( or AS (
-            parts = re.split(r'(\bAS)\s*\(', line, 1, re.IGNORECASE)
+            parts = _AS_PAREN_SPLIT_RE.split(line, 1)
             if len(parts) >= 3:
                 before_as = parts[0].strip()
                 as_part = parts[1].strip()
@@ -431,13 +552,13 @@ class RiverFormatter:
                     formatted_content = self._format_line_preserving_tokens(after_paren)
                     result_lines.append(formatted_content)
                 
-                return '\n'.join(result_lines)
+                return result_lines
         
         # Check if this line is a closing bracket for CTE
         if line.strip() == ')':
             # Position closing bracket at river + 1
             close_paren_pos = self.primary_river_pos + 1
-            return f"{' ' * close_paren_pos})"
+            return [')'.rjust(close_paren_pos + 1)]
         
         # Check if line ends with closing bracket
         if line.strip().endswith(')') and len(line.strip()) > 1:
@@ -450,8 +571,8 @@ class RiverFormatter:
                 result_lines.append(formatted_content)
                 # Closing bracket line
                 close_paren_pos = self.primary_river_pos + 1
-                result_lines.append(f"{' ' * close_paren_pos})")
-                return '\n'.join(result_lines)
+                result_lines.append(')'.rjust(close_paren_pos + 1))
+                return result_lines
         
         return None  # No special bracket processing needed
     
@@ -484,8 +605,7 @@ class RiverFormatter:
                         # Strip leading spaces to check if it starts with comma
                         stripped_next = next_non_empty_line.lstrip()
                         if (stripped_next.startswith(',') or 
-                            any(stripped_next.upper().startswith(clause) 
-                                for clause in ['SELECT', 'INSERT', 'UPDATE', 'DELETE'])):
+                            _MAIN_QUERY_START_RE.match(stripped_next)):
                             result_lines.append('')  # Add blank line after CTE end
         
         return result_lines
@@ -493,16 +613,11 @@ class RiverFormatter:
     def _format_comment_line(self, line: str) -> str:
         """Format comment lines with proper indentation"""
         # Normalize multiple spaces after -- to single space
-        comment_content = re.sub(r'^--\s*', '-- ', line)
+        comment_content = _COMMENT_PREFIX_RE.sub('-- ', line)
         
         # Check for comment with SQL keywords (-- SELECT, -- JOIN, etc.)
-        comment_clause_patterns = [
-            (r'^--\s*,', '-- ,'),  # Comment comma
-            (r'^--\s*(SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|INNER\s+JOIN|LEFT\s+JOIN|RIGHT\s+JOIN|FULL\s+OUTER\s+JOIN|LEFT\s+OUTER\s+JOIN|RIGHT\s+OUTER\s+JOIN|FULL\s+JOIN|CROSS\s+JOIN|JOIN|UNION\s+ALL|UNION|WITH|AS|CREATE\s+TEMP\s+TABLE|CREATE\s+TABLE|INSERT\s+INTO|UPDATE|SET|DELETE|DECLARE|DO)\b', '-- {keyword}')
-        ]
-        
-        for pattern, template in comment_clause_patterns:
-            match = re.match(pattern, comment_content, re.IGNORECASE)
+        for pattern, template in _COMMENT_CLAUSE_PATTERNS:
+            match = pattern.match(comment_content)
             if match:
                 if '{keyword}' in template:
                     keyword = match.group(1).upper()
@@ -514,86 +629,87 @@ class RiverFormatter:
                 keyword_end = match.end()
                 remaining = comment_content[keyword_end:].strip()
                 
-                clause_pos = self.primary_river_pos - len(clause)
-                if remaining:
-                    return f"{' ' * clause_pos}{clause} {remaining}"
-                else:
-                    return f"{' ' * clause_pos}{clause}"
+                # Right-justify the clause so it ends at the river
+                return self._emit_clause(clause, remaining)
         
         # Default comment (-- explanation text)
         clause = '--'
         remaining = comment_content[2:].strip()
-        clause_pos = self.primary_river_pos - len(clause)
-        if remaining:
-            return f"{' ' * clause_pos}{clause} {remaining}"
-        else:
-            return f"{' ' * clause_pos}{clause}"
+        return self._emit_clause(clause, remaining)
     
     def _is_case_clause(self, line: str) -> bool:
         """Check if line contains CASE statement clauses"""
-        for pattern in self.secondary_clause_patterns:
-            if re.match(pattern, line, re.IGNORECASE):
-                return True
-        return False
+        return self._leading_case_keyword(line) is not None
+    
+    def _leading_case_keyword(self, line: str) -> Optional[str]:
+        """Return the CASE keyword that starts line as a whole word, uppercased, or None"""
+        # Keywords are 3 or 4 letters long, so look them up by prefix
+        # instead of trying a pattern per keyword
+        for length in (4, 3):
+            if len(line) < length:
+                continue
+            keyword = line[:length].upper()
+            if keyword in _CASE_KEYWORDS:
+                # Word boundary, as \b: no word character may follow
+                if len(line) == length or not (line[length].isalnum() or line[length] == '_'):
+                    return keyword
+        return None
     
     def _format_case_clause(self, line: str) -> str:
         """Format CASE statement clauses using secondary river"""
         # Handle combined CASE WHEN THEN lines (comma-first)
-        comma_case_match = re.match(r'(,\s*CASE\s+WHEN\s+.*?)\s+(THEN\s+.*)', line, re.IGNORECASE)
+        comma_case_match = _COMMA_CASE_WHEN_THEN_RE.match(line)
         if comma_case_match:
             comma_case_when_part = comma_case_match.group(1).strip()
             then_part = comma_case_match.group(2).strip()
-            # Handle comma-first formatting
-            comma_pos = self.primary_river_pos - 1  
-            content_pos = self.primary_river_pos + 1
+            # Handle comma-first formatting: comma at river - 1, content at river + 1
             # Extract just the CASE WHEN part without comma
             case_when_part = comma_case_when_part[1:].strip()  # Remove comma
-            return f"{' ' * comma_pos},{' ' * (content_pos - comma_pos - 1)}{case_when_part} {then_part}"
+            return f"{','.rjust(self.primary_river_pos)} {case_when_part} {then_part}"
         
         # Handle combined CASE WHEN THEN lines (non-comma)
-        case_when_then_match = re.match(r'(CASE\s+WHEN\s+.*?)\s+(THEN\s+.*)', line, re.IGNORECASE)
+        case_when_then_match = _CASE_WHEN_THEN_RE.match(line)
         if case_when_then_match:
             case_when_part = case_when_then_match.group(1).strip()
             then_part = case_when_then_match.group(2).strip()
             # Position CASE at primary river, rest follows naturally
             case_pos = self.primary_river_pos - 4  # len('CASE')
-            return f"{' ' * max(0, case_pos)}{case_when_part} {then_part}"
+            return f"{case_when_part.rjust(case_pos + len(case_when_part))} {then_part}"
         
         # Handle combined WHEN THEN lines
-        when_then_match = re.match(r'(WHEN\s+.*?)\s+(THEN\s+.*)', line, re.IGNORECASE)
+        when_then_match = _WHEN_THEN_RE.match(line)
         if when_then_match:
             when_part = when_then_match.group(1).strip()
             then_part = when_then_match.group(2).strip()
             # Position WHEN at secondary river, THEN follows naturally
             when_pos = self.secondary_river_pos - 4  # len('WHEN')
-            return f"{' ' * max(0, when_pos)}{when_part} {then_part}"
+            return f"{when_part.rjust(when_pos + len(when_part))} {then_part}"
         
         # Handle individual CASE clauses
-        for pattern in self.secondary_clause_patterns:
-            match = re.match(pattern, line, re.IGNORECASE)
-            if match:
-                clause = match.group().strip().upper()
-                remaining = line[len(match.group()):].strip()
-                
-                # Special handling for different CASE clauses
-                if clause == 'CASE':
-                    # CASE gets normal LEFT_CLAUSE positioning (primary river)
-                    clause_pos = self.primary_river_pos - len(clause)
-                elif clause in ['WHEN', 'THEN', 'ELSE']:
-                    # WHEN/THEN/ELSE use secondary river positioning
-                    # Secondary river = primary + 9 (fixed for CASE context)
-                    clause_pos = self.secondary_river_pos - len(clause)
-                elif clause == 'END':
-                    # END positioned at secondary river (aligned with WHEN/THEN/ELSE)
-                    clause_pos = self.secondary_river_pos - len(clause)
-                else:
-                    # Default secondary river position
-                    clause_pos = self.secondary_river_pos - len(clause)
-                
-                if remaining:
-                    return f"{' ' * max(0, clause_pos)}{clause} {remaining}"
-                else:
-                    return f"{' ' * max(0, clause_pos)}{clause}"
+        clause = self._leading_case_keyword(line)
+        if clause:
+            remaining = line[len(clause):].strip()
+            
+            # Special handling for different CASE clauses
+            if clause == 'CASE':
+                # CASE gets normal LEFT_CLAUSE positioning (primary river)
+                clause_pos = self.primary_river_pos - len(clause)
+            elif clause in ['WHEN', 'THEN', 'ELSE']:
+                # WHEN/THEN/ELSE use secondary river positioning
+                # Secondary river = primary + 9 (fixed for CASE context)
+                clause_pos = self.secondary_river_pos - len(clause)
+            elif clause == 'END':
+                # END positioned at secondary river (aligned with WHEN/THEN/ELSE)
+                clause_pos = self.secondary_river_pos - len(clause)
+            else:
+                # Default secondary river position
+                clause_pos = self.secondary_river_pos - len(clause)
+            
+            clause = clause.rjust(clause_pos + len(clause))
+            if remaining:
+                return f"{clause} {remaining}"
+            else:
+                return clause
         
         # Fallback to standard formatting
         return self._format_line_preserving_tokens(line)
@@ -601,7 +717,7 @@ class RiverFormatter:
     def _is_subquery_line(self, line: str) -> bool:
         """Check if line contains subquery patterns"""
         # Look for (SELECT pattern - main indicator
-        if re.search(r'\(\s*SELECT\b', line, re.IGNORECASE):
+        if _SUBQUERY_SELECT_RE.search(line):
             return True
         
         # Don't treat other clauses as subquery unless they have clear subquery indicators
@@ -617,7 +733,7 @@ class RiverFormatter:
                 return True
         
         # Also check for CASE WHEN
-        if re.match(r'\bCASE\s+WHEN\b', line, re.IGNORECASE):
+        if _CASE_WHEN_RE.match(line):
             return True
             
         return False
@@ -630,9 +746,9 @@ class RiverFormatter:
     def _format_subquery_line(self, line: str) -> str:
         """Format subquery lines with nested indentation"""
         # Handle opening parenthesis with SELECT
-        if re.search(r'\(\s*SELECT\b', line, re.IGNORECASE):
+        if _SUBQUERY_SELECT_RE.search(line):
             # Split into parts: before (, SELECT, after SELECT
-            match = re.search(r'(.*?)\(\s*(SELECT\b)(.*)', line, re.IGNORECASE)
+            match = _SUBQUERY_SPLIT_RE.search(line)
             if match:
                 before_paren = match.group(1).strip()
                 select_keyword = match.group(2).upper()
@@ -647,15 +763,16 @@ class RiverFormatter:
                 
                 # Add opening parenthesis at river + 1
                 paren_pos = self.primary_river_pos + 1
-                result_lines.append(f"{' ' * paren_pos}(")
+                result_lines.append('('.rjust(paren_pos + 1))
                 
                 # Format SELECT with secondary river positioning
                 if self.secondary_river_pos:
-                    select_pos = self.secondary_river_pos - len(select_keyword)
+                    # Right-justify SELECT so it ends at the secondary river
+                    select_clause = select_keyword.rjust(self.secondary_river_pos)
                     if after_select:
-                        select_line = f"{' ' * max(0, select_pos)}{select_keyword} {after_select}"
+                        select_line = f"{select_clause} {after_select}"
                     else:
-                        select_line = f"{' ' * max(0, select_pos)}{select_keyword}"
+                        select_line = select_clause
                 else:
                     # Fallback to standard formatting
                     if after_select:
@@ -669,581 +786,300 @@ class RiverFormatter:
         # Fallback to standard formatting
         return self._format_line_preserving_tokens(line)
     
-    def _split_into_logical_lines(self, sql: str) -> List[str]:
-        """Split SQL into logical lines for comma-first formatting"""
-        sql = sql.strip()
-        if not sql:
-            return []
+    def _split_into_logical_lines(self, sql: str) -> List[Tuple[str, str]]:
+        """Split stripped, non-blank SQL into (LineKind, text) logical lines for comma-first formatting"""
+        
+        # Uppercased shadow of the input for keyword comparisons, built once.
+        # Tokens are tracked as (start, end) indices into both strings.
+        sql_upper = sql.upper()
+        if len(sql_upper) != len(sql):
+            # Some characters grow when uppercased (e.g. 'ß' -> 'SS'); fall
+            # back to a one-to-one table so indices into the shadow line up
+            sql_upper = sql.translate(_KEYWORD_UPPER)
+        sql_len = len(sql)
             
         lines = []
         current_tokens = []
+        current_kind = LineKind.CONTINUATION
         i = 0
         
         # Simple tokenization for splitting
-        while i < len(sql):
-            # Skip whitespace
-            while i < len(sql) and sql[i].isspace():
-                i += 1
-            if i >= len(sql):
+        while i < sql_len:
+            # Skip whitespace and read the next token in one search
+            match = _TOKEN_RE.search(sql, i)
+            if not match:
                 break
-                
-            # Read next token
-            token_start = i
-            if sql[i] in ',;':
-                # Single character tokens
-                token = sql[i]
-                i += 1
-            else:
-                # Multi-character tokens
-                while i < len(sql) and not sql[i].isspace() and sql[i] not in ',;':
-                    i += 1
-                token = sql[token_start:i]
+            token_start, i = match.span()
+            word = sql_upper[token_start:i]
             
-            if token == ',' and current_tokens:
+            if word == ',' and current_tokens:
                 # End current line and start comma line
-                if current_tokens:
-                    lines.append(' '.join(current_tokens))
-                    current_tokens = []
+                lines.append((current_kind, ' '.join(current_tokens)))
                 # Start new line with comma
                 current_tokens = [',']
+                current_kind = LineKind.COMMA
                 
-            elif token == ';':
+            elif word == ';':
                 # End current line and add semicolon line
                 if current_tokens:
-                    lines.append(' '.join(current_tokens))
+                    lines.append((current_kind, ' '.join(current_tokens)))
                     current_tokens = []
-                lines.append(';')
+                lines.append((LineKind.SEMICOLON, ';'))
                 
-            elif token.upper() in ['SELECT', 'FROM', 'WHERE', 'GROUP', 'BY', 'ORDER', 'HAVING', 'UNION', 'AND', 'OR'] or token.startswith('--'):
+            elif word in _SPLIT_KEYWORDS or sql.startswith('--', token_start):
+                token = sql[token_start:i]
+                keyword = word
                 # Check for compound keywords
-                if token.upper() in ['GROUP', 'ORDER', 'UNION'] and i < len(sql):
+                if word in _COMPOUND_HEADS and i < sql_len:
                     # Look ahead for BY/ALL
-                    next_start = i
-                    while next_start < len(sql) and sql[next_start].isspace():
-                        next_start += 1
-                    if next_start < len(sql):
-                        if token.upper() == 'GROUP' and sql[next_start:next_start+2].upper() == 'BY':
+                    match = _NONSPACE_RE.search(sql, i)
+                    if match:
+                        next_start = match.start()
+                        if word == 'GROUP' and sql_upper.startswith('BY', next_start):
                             # Skip whitespace and BY
-                            while i < len(sql) and sql[i].isspace():
-                                i += 1
-                            i += 2  # Skip "BY"
-                            token = 'GROUP BY'
-                        elif token.upper() == 'ORDER' and sql[next_start:next_start+2].upper() == 'BY':
-                            while i < len(sql) and sql[i].isspace():
-                                i += 1
-                            i += 2  # Skip "BY"
-                            token = 'ORDER BY'
-                        elif token.upper() == 'UNION' and sql[next_start:next_start+3].upper() == 'ALL':
-                            while i < len(sql) and sql[i].isspace():
-                                i += 1
-                            i += 3  # Skip "ALL"
-                            token = 'UNION ALL'
+                            i = next_start + 2
+                            token = keyword = 'GROUP BY'
+                        elif word == 'ORDER' and sql_upper.startswith('BY', next_start):
+                            i = next_start + 2
+                            token = keyword = 'ORDER BY'
+                        elif word == 'UNION' and sql_upper.startswith('ALL', next_start):
+                            i = next_start + 3
+                            token = keyword = 'UNION ALL'
                 
-                # Start new line for major clauses (except AND/OR which continue)
-                if token.upper() in ['AND', 'OR']:
-                    # AND/OR start new lines
-                    if current_tokens:
-                        lines.append(' '.join(current_tokens))
-                        current_tokens = []
-                    current_tokens = [token]
+                # Major clauses and AND/OR start new lines
+                if current_tokens:
+                    lines.append((current_kind, ' '.join(current_tokens)))
+                current_tokens = [token]
+                if word in _SPLIT_KEYWORDS:
+                    # Bare GROUP/ORDER/BY are not clauses on their own
+                    current_kind = _LINE_KIND_BY_KEYWORD.get(keyword, LineKind.CONTINUATION)
                 else:
-                    # Other clauses start new lines
-                    if current_tokens:
-                        lines.append(' '.join(current_tokens))
-                        current_tokens = []
-                    current_tokens = [token]
+                    current_kind = LineKind.COMMENT
             else:
-                current_tokens.append(token)
+                if not current_tokens:
+                    current_kind = LineKind.COMMA if word == ',' else LineKind.CONTINUATION
+                current_tokens.append(sql[token_start:i])
         
         # Add final line
         if current_tokens:
-            lines.append(' '.join(current_tokens))
+            lines.append((current_kind, ' '.join(current_tokens)))
             
         return lines
     
-    def _format_line_preserving_tokens(self, line: str, in_subquery: bool = False) -> str:
+    def _format_line_preserving_tokens(self, line: str, in_subquery: bool = False, kind: Optional[str] = None) -> str:
         """Format a single line while preserving all original tokens"""
         if not line:
             return ''
         
+        stripped = line.strip()
+        
+        # Lines classified while splitting go straight to their formatter
+        formatter = self._kind_formatters.get(kind)
+        if formatter is not None:
+            return formatter(stripped, in_subquery)
+        
+        upper = stripped.upper()
+        
         # For simple cases, handle SELECT + first item specially
-        if line.strip().upper().startswith('SELECT '):
-            # Extract SELECT and first item only
-            content = line.strip()[7:]  # Remove "SELECT "
-            
-            # Choose river position based on context
-            if (in_subquery and self.secondary_river_pos and 
-                'SELECT' in self.secondary_clauses and 'CASE WHEN' in self.secondary_clauses):
-                # Use secondary river positioning for subquery SELECT
-                river_pos = self.secondary_river_pos
-            else:
-                # Use primary river positioning for main query SELECT
-                river_pos = self.primary_river_pos
-                
-            select_pos = river_pos - len('SELECT')
-            
-            if ',' in content:
-                # Has multiple items - take only first
-                first_item = content.split(',')[0].strip()
-                return f"{' ' * max(0, select_pos)}SELECT {first_item}"
-            else:
-                # Single item or no items
-                return f"{' ' * max(0, select_pos)}SELECT {content}"
+        if upper.startswith('SELECT '):
+            return self._format_select_line(stripped, in_subquery)
         
         # Handle comma-first lines
-        if line.strip().startswith(','):
-            content = line.strip()[1:].strip()  # Remove comma and whitespace
-            comma_pos = self.primary_river_pos - 2  # Position 11 for river=13
-            content_pos = self.primary_river_pos + 1  # Position 14 for river=13 (river+1)
-            # User wants 1 space between comma and content, but content at river+1
-            # This seems contradictory. Let me implement: comma at river-2, content at river+1, but only 1 space between
-            # Solution: move comma to river-1 instead of river-2
-            comma_pos = self.primary_river_pos - 1  # Position 12 for river=13
-            spaces_after_comma = content_pos - comma_pos - 1  # 14 - 12 - 1 = 1 space
-            return f"{' ' * comma_pos},{' ' * spaces_after_comma}{content}"
+        if stripped.startswith(','):
+            return self._format_comma_line(stripped)
         
         # Handle comment lines
-        if line.strip().startswith('--'):
-            return self._format_comment_line(line.strip())
+        if stripped.startswith('--'):
+            return self._format_comment_line(stripped)
         
         # Handle CASE statement clauses
-        if self._is_case_clause(line.strip()):
-            return self._format_case_clause(line.strip())
+        if self._is_case_clause(stripped):
+            return self._format_case_clause(stripped)
         
         # Handle subquery patterns (SELECT within parentheses)
-        if self._is_subquery_line(line.strip()):
-            return self._format_subquery_line(line.strip())
+        if self._is_subquery_line(stripped):
+            return self._format_subquery_line(stripped)
         
-        # Handle other LEFT_CLAUSE patterns with subquery context awareness
-        for pattern in self.left_clause_patterns:
-            match = re.match(pattern, line.strip(), re.IGNORECASE)
-            if match:
-                clause = match.group().strip()
-                remaining = line.strip()[len(clause):].strip()
-                
-                # Use secondary river positioning if in subquery context and we have both contexts
-                if (in_subquery and self.secondary_river_pos and 
-                    'SELECT' in self.secondary_clauses and 'CASE WHEN' in self.secondary_clauses and
-                    clause.upper() in ['SELECT', 'FROM', 'WHERE', 'GROUP BY', 'ORDER BY', 'HAVING']):
-                    # Use secondary river positioning for subquery clauses
-                    clause_pos = self.secondary_river_pos - len(clause)
-                else:
-                    # Use primary river positioning for main query clauses
-                    clause_pos = self.primary_river_pos - len(clause)
-                
-                if remaining:
-                    return f"{' ' * max(0, clause_pos)}{clause} {remaining}"
-                else:
-                    return f"{' ' * max(0, clause_pos)}{clause}"
+        # Handle other LEFT_CLAUSE patterns with subquery context awareness,
+        # trying the combined pattern only when the first letter can start one
+        match = stripped[:1] in _LEFT_CLAUSE_INITIALS and _COMBINED_LEFT_CLAUSE_RE.match(stripped)
+        if match:
+            clause = match.group().strip()
+            return self._format_clause_line(clause, stripped[len(clause):].strip(), in_subquery)
         
         # Handle AND/OR
-        if line.strip().upper().startswith('AND ') or line.strip().upper().startswith('OR '):
-            parts = line.strip().split(None, 1)
-            operator = parts[0].upper()
-            condition = parts[1] if len(parts) > 1 else ''
-            operator_pos = self.primary_river_pos - len(operator)
-            return f"{' ' * operator_pos}{operator} {condition}"
+        if upper.startswith(('AND ', 'OR ')):
+            return self._format_logical_op_line(stripped)
         
         # Handle semicolon
-        if line.strip() == ';':
-            semicolon_pos = self.primary_river_pos + 1
-            return f"{' ' * semicolon_pos};"
+        if stripped == ';':
+            return self._format_semicolon_line()
         
         # Default - treat as RIGHT_SENTENCE continuation
-        content = line.strip()
-        content_pos = self.primary_river_pos + 1
-        return f"{' ' * content_pos}{content}"
+        return self._format_continuation_line(stripped)
     
-    def _format_tokens_on_line(self, tokens: List[Dict]) -> str:
-        """Format all tokens that appear on a single line"""
-        if not tokens:
-            return ""
-        
-        # Analyze token structure
-        left_clauses = [t for t in tokens if t['type'] == 'LEFT_CLAUSE']
-        right_sentences = [t for t in tokens if t['type'] == 'RIGHT_SENTENCE']
-        commas = [t for t in tokens if t['type'] == 'COMMA']
-        semicolons = [t for t in tokens if t['type'] == 'SEMICOLON']
-        
-        if left_clauses and not commas:
-            # LEFT_CLAUSE + content pattern
-            left_clause = left_clauses[0]
-            
-            if left_clause.get('subtype') == 'LOGICAL_OP':
-                # AND/OR positioning
-                clause_pos = self.primary_river_pos - len(left_clause['content'])
-            else:
-                # Regular LEFT_CLAUSE positioning
-                clause_pos = self.primary_river_pos - len(left_clause['content'])
-            
-            line = ' ' * max(0, clause_pos) + left_clause['content']
-            
-            # Add right sentences
-            if right_sentences:
-                content = ' '.join(t['content'] for t in right_sentences)
-                line += ' ' + content
-            
-            # Add semicolon if present
-            if semicolons:
-                line += ';'
-            
-            return line
-            
-        elif commas and not left_clauses:
-            # Comma-first pattern
-            comma_pos = self.primary_river_pos - 2
-            line = ' ' * max(0, comma_pos) + ','
-            
-            if right_sentences:
-                # Position content at river + 1
-                content = ' '.join(t['content'] for t in right_sentences)
-                content_pos = self.primary_river_pos + 1
-                current_pos = comma_pos + 1  # After comma
-                spaces_needed = content_pos - current_pos
-                line += ' ' * max(1, spaces_needed) + content
-            
-            return line
-            
-        elif right_sentences and not left_clauses and not commas:
-            # Pure RIGHT_SENTENCE (continuation or standalone)
-            content_pos = self.primary_river_pos + 1
-            content = ' '.join(t['content'] for t in right_sentences)
-            line = ' ' * max(0, content_pos) + content
-            
-            if semicolons:
-                line += ';'
-                
-            return line
-            
-        elif semicolons and not left_clauses and not right_sentences and not commas:
-            # Just semicolon
-            semi_pos = self.primary_river_pos
-            return ' ' * max(0, semi_pos) + ';'
-            
-        else:
-            # Mixed or complex pattern - handle as best we can
-            result = ""
-            for token in tokens:
-                if token['type'] == 'LEFT_CLAUSE':
-                    if token.get('subtype') == 'LOGICAL_OP':
-                        pos = self.primary_river_pos - len(token['content'])
-                    else:
-                        pos = self.primary_river_pos - len(token['content'])
-                    result = ' ' * max(0, pos) + token['content'] + ' '
-                elif token['type'] == 'COMMA':
-                    pos = self.primary_river_pos - 2
-                    result += ' ' * max(0, pos - len(result)) + ', '
-                elif token['type'] == 'RIGHT_SENTENCE':
-                    result += token['content'] + ' '
-                elif token['type'] == 'SEMICOLON':
-                    result += ';'
-            
-            return result.rstrip()
+    def _format_select_kind(self, line: str, in_subquery: bool) -> str:
+        """Format a line split off at SELECT"""
+        if ' ' in line:
+            return self._format_select_line(line, in_subquery)
+        return self._format_clause_line(line, '', in_subquery)
     
-    def _tokenize_preserve_content(self, sql: str) -> List[Dict]:
-        """Tokenize SQL preserving all original content"""
-        tokens = []
-        i = 0
-        current_token = ""
-        
-        while i < len(sql):
-            char = sql[i]
-            
-            if char == '\n':
-                # Finish current token if exists
-                if current_token.strip():
-                    tokens.append(self._classify_token(current_token.strip()))
-                    current_token = ""
-                # Add newline token
-                tokens.append({'type': 'NEWLINE', 'content': '\n'})
-                
-            elif char.isspace():
-                # Finish current token if exists
-                if current_token.strip():
-                    tokens.append(self._classify_token(current_token.strip()))
-                    current_token = ""
-                # Collect whitespace
-                whitespace = char
-                j = i + 1
-                while j < len(sql) and sql[j].isspace() and sql[j] != '\n':
-                    whitespace += sql[j]
-                    j += 1
-                tokens.append({'type': 'WHITESPACE', 'content': whitespace})
-                i = j - 1
-                
-            elif char == ',':
-                # Finish current token if exists
-                if current_token.strip():
-                    tokens.append(self._classify_token(current_token.strip()))
-                    current_token = ""
-                # Add comma as separate token
-                tokens.append({'type': 'COMMA', 'content': ','})
-                
-            elif char == ';':
-                # Finish current token if exists  
-                if current_token.strip():
-                    tokens.append(self._classify_token(current_token.strip()))
-                    current_token = ""
-                # Add semicolon as separate token
-                tokens.append({'type': 'SEMICOLON', 'content': ';'})
-                
-            else:
-                current_token += char
-            
-            i += 1
-        
-        # Add final token if exists
-        if current_token.strip():
-            tokens.append(self._classify_token(current_token.strip()))
-        
-        return tokens
+    def _format_clause_kind(self, line: str, in_subquery: bool) -> str:
+        """Format a line split off at a major clause keyword"""
+        # Only a parenthesised subquery changes how these are formatted
+        if self._is_subquery_line(line):
+            return self._format_subquery_line(line)
+        clause = next((c for c in _COMPOUND_CLAUSES if line.startswith(c)), None)
+        if clause is None:
+            clause = line.partition(' ')[0]
+        return self._format_clause_line(clause, line[len(clause):].strip(), in_subquery)
     
-    def _classify_token(self, content: str) -> Dict:
-        """Classify a token as LEFT_CLAUSE or RIGHT_SENTENCE"""
-        # Special case for AND/OR - they are LEFT_CLAUSE but with special positioning
-        if content.upper() in ['AND', 'OR']:
-            return {'type': 'LEFT_CLAUSE', 'content': content, 'subtype': 'LOGICAL_OP'}
-        
-        # Check if it matches any LEFT CLAUSE pattern
-        for pattern in self.left_clause_patterns:
-            if re.match(pattern + r'$', content, re.IGNORECASE):
-                return {'type': 'LEFT_CLAUSE', 'content': content}
-        
-        # Default to RIGHT_SENTENCE
-        return {'type': 'RIGHT_SENTENCE', 'content': content}
+    def _format_and_or_kind(self, line: str, in_subquery: bool) -> str:
+        """Format a line split off at AND/OR"""
+        if self._is_subquery_line(line):
+            return self._format_subquery_line(line)
+        if ' ' in line:
+            return self._format_logical_op_line(line)
+        return self._format_continuation_line(line)
     
-    def _format_token(self, token: Dict) -> str:
-        """Format a single token based on its type"""
-        if token['type'] == 'LEFT_CLAUSE':
-            # Position LEFT CLAUSE at river - clause_length
-            clause_pos = self.primary_river_pos - len(token['content'])
-            spaces = ' ' * max(0, clause_pos)
-            return f"{spaces}{token['content']} "
-            
-        elif token['type'] == 'COMMA':
-            # Position comma at river - 2, followed by space to reach river + 1
-            comma_pos = self.primary_river_pos - 2
-            spaces = ' ' * max(0, comma_pos)
-            return f"{spaces}, "
-            
-        elif token['type'] == 'RIGHT_SENTENCE':
-            # Position at river + 1
-            content_pos = self.primary_river_pos + 1
-            spaces = ' ' * max(0, content_pos)
-            return f"{spaces}{token['content']}"
-            
-        elif token['type'] == 'SEMICOLON':
-            # Position at river
-            semi_pos = self.primary_river_pos
-            spaces = ' ' * max(0, semi_pos)
-            return f"{spaces};"
-            
+    def _format_select_line(self, line: str, in_subquery: bool) -> str:
+        """Format SELECT with its first item; remaining items become comma-first lines"""
+        # Extract SELECT and first item only
+        content = line[7:]  # Remove "SELECT "
+        
+        # Choose river position based on context
+        if (in_subquery and self.secondary_river_pos and 
+            'SELECT' in self.secondary_clauses and 'CASE WHEN' in self.secondary_clauses):
+            # Use secondary river positioning for subquery SELECT
+            river_pos = self.secondary_river_pos
         else:
-            return token['content']
-    
-    def _group_tokens_by_line_logic(self, tokens: List[Dict]) -> List[List[Dict]]:
-        """Group tokens into logical lines based on SQL formatting rules"""
-        groups = []
-        current_group = []
-        
-        i = 0
-        while i < len(tokens):
-            token = tokens[i]
-            
-            if token['type'] == 'NEWLINE':
-                # End current group if it has content
-                if current_group:
-                    groups.append(current_group)
-                    current_group = []
-                # Empty lines are preserved
-                else:
-                    groups.append([])
-                    
-            elif token['type'] == 'WHITESPACE':
-                # Skip whitespace - we format our own
-                pass
-                
-            elif token['type'] == 'LEFT_CLAUSE':
-                # LEFT_CLAUSE starts a new logical line
-                if current_group:
-                    groups.append(current_group)
-                    current_group = []
-                current_group.append(token)
-                
-                # For SELECT, collect first item on same line, then start comma-first for rest
-                if token['content'].upper() == 'SELECT':
-                    # Collect first RIGHT_SENTENCE only
-                    j = i + 1
-                    found_first_sentence = False
-                    while j < len(tokens):
-                        next_token = tokens[j]
-                        if next_token['type'] == 'LEFT_CLAUSE':
-                            break
-                        elif next_token['type'] == 'RIGHT_SENTENCE' and not found_first_sentence:
-                            current_group.append(next_token)
-                            found_first_sentence = True
-                        elif next_token['type'] == 'COMMA' and found_first_sentence:
-                            # Stop here - comma starts new line
-                            break
-                        elif next_token['type'] != 'WHITESPACE' and next_token['type'] != 'NEWLINE':
-                            if found_first_sentence:
-                                break
-                        j += 1
-                    i = j - 1
-                else:
-                    # Other LEFT_CLAUSES collect everything until next LEFT_CLAUSE
-                    j = i + 1
-                    while j < len(tokens):
-                        next_token = tokens[j]
-                        if next_token['type'] == 'LEFT_CLAUSE':
-                            break
-                        elif next_token['type'] != 'WHITESPACE' and next_token['type'] != 'NEWLINE':
-                            current_group.append(next_token)
-                        j += 1
-                    i = j - 1
-                
-            elif token['type'] in ['COMMA', 'RIGHT_SENTENCE', 'SEMICOLON']:
-                # These can start their own lines or continue existing ones
-                if current_group:
-                    # Check if this should be on the same line as previous
-                    # For now, comma-first style means comma starts new line
-                    if token['type'] == 'COMMA':
-                        groups.append(current_group)
-                        current_group = [token]
-                        
-                        # Look ahead for content after comma until newline or next clause
-                        j = i + 1
-                        while j < len(tokens):
-                            next_token = tokens[j]
-                            if next_token['type'] == 'LEFT_CLAUSE':
-                                break
-                            elif next_token['type'] == 'NEWLINE':
-                                # Check if there's content after newline that belongs with this comma
-                                k = j + 1
-                                while k < len(tokens) and tokens[k]['type'] == 'WHITESPACE':
-                                    k += 1
-                                if k < len(tokens) and tokens[k]['type'] == 'RIGHT_SENTENCE':
-                                    # Include the content after newline with this comma
-                                    current_group.append(tokens[k])
-                                    i = k
-                                break
-                            elif next_token['type'] == 'RIGHT_SENTENCE':
-                                current_group.append(next_token)
-                                break
-                            j += 1
-                        if j <= i:
-                            i = j - 1
-                    else:
-                        current_group.append(token)
-                else:
-                    current_group.append(token)
+            # Use primary river positioning for main query SELECT
+            river_pos = self.primary_river_pos
             
-            i += 1
-        
-        # Add final group if exists
-        if current_group:
-            groups.append(current_group)
+        # Right-justify SELECT so it ends at the river
+        select_clause = 'SELECT'.rjust(river_pos)
         
-        return groups
+        if ',' in content:
+            # Has multiple items - take only first
+            first_item = content.partition(',')[0].strip()
+            return f"{select_clause} {first_item}"
+        else:
+            # Single item or no items
+            return f"{select_clause} {content}"
     
-    def _format_token_group(self, token_group: List[Dict]) -> str:
-        """Format a group of tokens that belong on the same line"""
-        if not token_group:
-            return ""
-        
-        # Analyze the group structure
-        has_left_clause = any(t['type'] == 'LEFT_CLAUSE' for t in token_group)
-        has_comma = any(t['type'] == 'COMMA' for t in token_group)
-        
-        if has_left_clause and not has_comma:
-            # Standard LEFT_CLAUSE + RIGHT_SENTENCE pattern
-            left_clause = next(t for t in token_group if t['type'] == 'LEFT_CLAUSE')
-            right_sentences = [t for t in token_group if t['type'] == 'RIGHT_SENTENCE']
-            
-            # Check if this is a logical operator (AND/OR)
-            if left_clause.get('subtype') == 'LOGICAL_OP':
-                # Position AND/OR at river - len(operator)
-                clause_pos = self.primary_river_pos - len(left_clause['content'])
-                line = ' ' * max(0, clause_pos) + left_clause['content']
-            else:
-                # Position LEFT_CLAUSE normally
-                clause_pos = self.primary_river_pos - len(left_clause['content'])
-                line = ' ' * max(0, clause_pos) + left_clause['content']
-            
-            # Add RIGHT_SENTENCES
-            if right_sentences:
-                content = ' '.join(t['content'] for t in right_sentences)
-                line += ' ' + content
-                
-            return line
-            
-        elif has_comma:
-            # Comma-first pattern: , content
-            right_sentences = [t for t in token_group if t['type'] == 'RIGHT_SENTENCE']
-            
-            # Position comma at river-2
-            comma_pos = self.primary_river_pos - 2
-            line = ' ' * max(0, comma_pos) + ','
-            
-            # Add content at river+1
-            if right_sentences:
-                content = ' '.join(t['content'] for t in right_sentences)
-                content_pos = self.primary_river_pos + 1
-                current_pos = comma_pos + 1  # After comma
-                spaces_needed = content_pos - current_pos
-                line += ' ' * max(1, spaces_needed) + content
-                
-            return line
-            
+    def _format_comma_line(self, line: str) -> str:
+        """Format a comma-first continuation line"""
+        content = line[1:].strip()  # Remove comma and whitespace
+        # Comma at river-1 (position 12 for river=13), then 1 space so
+        # content starts at river+1 (position 14 for river=13)
+        return f"{','.rjust(self.primary_river_pos)} {content}"
+    
+    def _format_clause_line(self, clause: str, remaining: str, in_subquery: bool) -> str:
+        """Format a LEFT CLAUSE ending at the river, followed by its content"""
+        # Use secondary river positioning if in subquery context and we have both contexts
+        if (in_subquery and self.secondary_river_pos and 
+            'SELECT' in self.secondary_clauses and 'CASE WHEN' in self.secondary_clauses and
+            clause.upper() in ['SELECT', 'FROM', 'WHERE', 'GROUP BY', 'ORDER BY', 'HAVING']):
+            # Use secondary river positioning for subquery clauses
+            clause_end = self.secondary_river_pos
         else:
-            # Other patterns (semicolon, standalone RIGHT_SENTENCE)
-            semicolons = [t for t in token_group if t['type'] == 'SEMICOLON']
-            right_sentences = [t for t in token_group if t['type'] == 'RIGHT_SENTENCE']
-            
-            if semicolons and not right_sentences:
-                # Just semicolon
-                semi_pos = self.primary_river_pos
-                return ' ' * max(0, semi_pos) + ';'
-            elif right_sentences:
-                # RIGHT_SENTENCE (potentially with semicolon)
-                content = ' '.join(t['content'] for t in right_sentences)
-                content_pos = self.primary_river_pos + 1
-                line = ' ' * max(0, content_pos) + content
-                
-                if semicolons:
-                    line += ';'
-                    
-                return line
-            else:
-                return ""
+            # Use primary river positioning for main query clauses
+            return self._emit_clause(clause, remaining)
+        
+        if remaining:
+            return f"{clause.rjust(clause_end)} {remaining}"
+        else:
+            return clause.rjust(clause_end)
+    
+    def _format_logical_op_line(self, line: str) -> str:
+        """Format an AND/OR line with the operator ending at the river"""
+        parts = line.split(None, 1)
+        operator = parts[0].upper()
+        condition = parts[1] if len(parts) > 1 else ''
+        return f"{operator.rjust(self.primary_river_pos)} {condition}"
     
+    def _format_semicolon_line(self) -> str:
+        """Format a statement terminator at river + 1"""
+        return ';'.rjust(self.primary_river_pos + 2)
     
+    def _format_continuation_line(self, line: str) -> str:
+        """Format a RIGHT_SENTENCE continuation at river + 1"""
+        return line.rjust(self.primary_river_pos + 1 + len(line))
     
     def verify_river_lines(self, formatted_sql: str) -> bool:
         """Verify that river line positions contain only spaces"""
-        lines = formatted_sql.split('\n')
-        
-        for line_num, line in enumerate(lines, 1):
-            if len(line) > self.primary_river_pos:
-                char_at_river = line[self.primary_river_pos]
-                # River position should always have space, except in CASE statement contexts
-                is_case_context = any(clause_word in line.upper() for clause_word in ['WHEN ', 'THEN ', 'ELSE ', 'END '])
-                if char_at_river != ' ' and not is_case_context:
-                    print(f"River line verification failed at line {line_num}")
-                    print(f"Expected space at position {self.primary_river_pos}, found: '{char_at_river}'")
-                    print(f"Line: '{line}'")
-                    return False
-            elif line.strip():  # Non-empty line shorter than river position
-                # This is OK for lines that end before the river
-                pass
+        if not self.primary_river_pos:
+            # Nothing was aligned to a river (e.g. input without SQL keywords)
+            return True
+        
+        river = self.primary_river_pos
+        
+        # Let the regex engine find the lines whose river position holds
+        # something other than a space, instead of walking every line
+        for match in _river_violation_re(river).finditer(formatted_sql):
+            pos = match.start()
+            end = formatted_sql.find('\n', pos)
+            line = formatted_sql[pos:end] if end >= 0 else formatted_sql[pos:]
+            # River position should always have space, except in CASE statement contexts
+            is_case_context = _CASE_CONTEXT_RE.search(line) is not None
+            if not is_case_context:
+                line_num = formatted_sql.count('\n', 0, pos) + 1
+                print(f"River line verification failed at line {line_num}")
+                print(f"Expected space at position {river}, found: '{formatted_sql[pos + river]}'")
+                print(f"Line: '{line}'")
+                return False
         
         return True
 
+@functools.lru_cache(maxsize=None)
+def _river_violation_re(river: int) -> re.Pattern:
+    """Compiled pattern for lines holding a non-space character at the river position"""
+    return re.compile(rf'^[^\n]{{{river}}}[^ \n]', re.MULTILINE)
+
+@functools.lru_cache(maxsize=256)
+def _format_sql_cached(formatter_class: type, sql: str) -> Tuple[str, _FormatState]:
+    """Format sql with a fresh formatter; returns the output and its saved state"""
+    formatter = formatter_class()
+    formatted = formatter._format_sql_uncached(sql)
+    return formatted, formatter._save_format_state()
+
+def format_sql(sql: str) -> str:
+    """Format sql with a throwaway formatter, for callers that only need the output"""
+    # Patterns are compiled at module level and results are cached, so a
+    # fresh formatter is cheap and keeps concurrent callers from sharing state
+    return RiverFormatter().format_sql(sql)
+
+def _read_stdin() -> str:
+    """Read and decode all of stdin at once, with text mode's newline handling"""
+    buffer = getattr(sys.stdin, 'buffer', None)
+    if buffer is None:
+        # A replaced stdin (e.g. io.StringIO) is already text
+        return sys.stdin.read()
+    data = buffer.read().decode(sys.stdin.encoding, sys.stdin.errors)
+    # Text-mode stdin only translates newlines where the platform uses '\r\n'
+    if os.linesep != '\n':
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+    return data
+
+def _write_stdout(text: str):
+    """Write text and a trailing newline to stdout with a single encode"""
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is None:
+        # A replaced stdout (e.g. io.StringIO) takes text directly
+        print(text)
+        return
+    # Flush anything already printed so output stays in order
+    sys.stdout.flush()
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    buffer.write((text + os.linesep).encode(sys.stdout.encoding, sys.stdout.errors))
+    buffer.flush()
+
 def main():
     try:
-        sql = sys.stdin.read()
+        sql = _read_stdin()
         
-        if not sql.strip():
+        if not sql or sql.isspace():
             print("-- No SQL input provided", file=sys.stderr)
             sys.exit(1)
         
@@ -1254,13 +1090,17 @@ def main():
         if not formatter.verify_river_lines(formatted):
             print("Warning: River line verification failed", file=sys.stderr)
         
-        print(formatted)
+        # Input passed through unchanged keeps its own final newline, so
+        # drop it rather than ending the output with a blank line
+        if formatted.endswith('\n'):
+            formatted = formatted[:-1]
+        _write_stdout(formatted)
         
     except Exception as e:
         print(f"Format error: {str(e)}", file=sys.stderr)
-        if 'sql' in locals() and sql.strip():
-            print(sql)
+        if 'sql' in locals() and sql and not sql.isspace():
+            _write_stdout(sql)
         sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()